@@ -0,0 +1,374 @@
+"""Compact on-disk vector store for small per-chat corpora.
+
+Vectors are L2-normalised and stored as float16, or as int8 with a per-row
+scale, in append-only files that are memory-mapped for search. Search is a brute-force
+matrix product, switching to an IVF probe once a chat holds IVF_MIN_ROWS
+chunks. The float32 vectors can optionally be kept as well, in which case the
+top candidates are re-ranked with them.
+"""
+import itertools
+import json
+import os
+import uuid
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+from app.rerank import normalize, mmr_select
+from app.locks import store_lock
+
+DTYPES = ("float16", "int8")
+META_FILE = "compact_meta.json"
+DOCUMENTS_FILE = "documents.jsonl"
+IVF_MIN_ROWS = int(os.getenv("COMPACT_IVF_MIN_ROWS", "20000"))
+IVF_NPROBE = int(os.getenv("COMPACT_IVF_NPROBE", "8"))
+# Candidates scored with quantized vectors per final result when re-ranking
+RERANK_FACTOR = 4
+# Rows dequantized at a time, which bounds the scratch memory of a search
+SEARCH_BLOCK_ROWS = 65536
+
+def quantize(vectors, dtype):
+    """Quantize normalised float32 rows, returning (matrix, per-row scales or None)."""
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    if dtype == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12).astype(np.float32)
+        return np.rint(vectors / scales[:, None] * 127).astype(np.int8), scales
+    raise ValueError(f"Unsupported compact dtype: {dtype}")
+
+def dequantize(matrix, scales):
+    """Inverse of quantize, as float32."""
+    vectors = np.asarray(matrix, dtype=np.float32)
+    if scales is not None:
+        vectors *= np.asarray(scales, dtype=np.float32)[:, None] / 127
+    return vectors
+
+def score_rows(matrix, scales, queries):
+    """Cosine scores of normalised queries (m, d) against quantized rows, shape (m, n)."""
+    scores = np.empty((queries.shape[0], matrix.shape[0]), dtype=np.float32)
+    for start in range(0, matrix.shape[0], SEARCH_BLOCK_ROWS):
+        stop = min(start + SEARCH_BLOCK_ROWS, matrix.shape[0])
+        block = np.asarray(matrix[start:stop], dtype=np.float32)
+        block_scores = queries @ block.T
+        if scales is not None:
+            block_scores *= scales[start:stop] / 127
+        scores[:, start:stop] = block_scores
+    return scores
+
+def top_k(scores, k):
+    """Indices of the k highest scores, best first."""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+def build_ivf(vectors, n_lists, iterations=10, seed=0):
+    """Spherical k-means over normalised rows, returning (centroids, assignments)."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(vectors.shape[0], n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        for i in range(n_lists):
+            members = vectors[assignments == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    return centroids, np.argmax(vectors @ centroids.T, axis=1).astype(np.int32)
+
+def create_compact_store(path, dtype="int8", keep_full=False):
+    """Create an empty store directory that already holds its meta file.
+
+    The directory is built under a temporary name and renamed into place, so a
+    store directory without compact_meta.json is never a compact store.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unsupported compact dtype: {dtype}")
+    tmp_path = f"{path.rstrip('/' + os.sep)}.{uuid.uuid4().hex}.tmp"
+    os.makedirs(tmp_path)
+    with open(os.path.join(tmp_path, META_FILE), "w") as f:
+        json.dump({"dtype": dtype, "keep_full": keep_full, "dim": None, "count": 0, "ivf_trained_rows": 0}, f)
+    os.rename(tmp_path, path)
+
+class CompactIndex:
+    """Quantized vector matrix in append-only, memory-mapped files in `path`.
+
+    Rows are appended to raw .bin files and only count once compact_meta.json
+    says so, so a reader never maps a half-written row. Writers hold the
+    store's lock file exclusively and readers hold it shared while loading,
+    which lets several worker processes share one index.
+    """
+
+    def __init__(self, path, dtype="int8", keep_full=False):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported compact dtype: {dtype}")
+        self.path = path
+        self.dtype = dtype
+        self.keep_full = keep_full
+        self.dim = None
+        self.count = 0
+        self.vectors = None
+        self.scales = None
+        self.full = None
+        self.centroids = None
+        self.assignments = None
+        self.ivf_trained_rows = 0
+        self.load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def lock(self, shared=False):
+        """Cross-process lock on the index; flock is not reentrant, so take it once."""
+        return store_lock(self.path, shared=shared)
+
+    def load(self):
+        """Map the rows committed on disk, including those added by other processes."""
+        with self.lock(shared=True):
+            self._load()
+
+    def _load(self):
+        if not os.path.exists(self._file(META_FILE)):
+            return
+        with open(self._file(META_FILE)) as f:
+            meta = json.load(f)
+        self.dtype = meta["dtype"]
+        self.keep_full = meta["keep_full"]
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self.ivf_trained_rows = meta.get("ivf_trained_rows", 0)
+        self._map(self.count)
+        if self.ivf_trained_rows:
+            self.centroids = np.load(self._file(f"ivf_{self.ivf_trained_rows}_centroids.npy"))
+            self.assignments = self._rows(f"ivf_{self.ivf_trained_rows}_assignments.bin", np.int32, self.count)
+
+    def _rows(self, name, dtype, count, width=None):
+        """Memory-map the first `count` rows of an append-only file."""
+        if not count:
+            return None
+        return np.memmap(self._file(name), dtype=dtype, mode="r", shape=(count,) if width is None else (count, width))
+
+    def _map(self, count):
+        self.vectors = self._rows("vectors.bin", self.dtype, count, self.dim)
+        self.scales = self._rows("scales.bin", np.float32, count) if self.dtype == "int8" else None
+        self.full = self._rows("full.bin", np.float32, count, self.dim) if self.keep_full else None
+
+    def _append(self, name, rows, committed):
+        """Append rows after the first `committed` ones, dropping any tail left by a failed writer."""
+        rows = np.ascontiguousarray(rows)
+        with open(self._file(name), "ab") as f:
+            f.truncate(committed * (rows.nbytes // len(rows)))
+            f.write(rows.tobytes())
+
+    def add(self, vectors):
+        """Append float vectors, picking up rows added by other processes first."""
+        with self.lock():
+            self._load()
+            self._add(vectors)
+
+    def _add(self, vectors):
+        # Callers hold self.lock() and have just reloaded with _load
+        vectors = normalize(vectors)
+        if vectors.size == 0:
+            return
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Expected {self.dim}-dimensional vectors, got {vectors.shape[1]}")
+        os.makedirs(self.path, exist_ok=True)
+        matrix, scales = quantize(vectors, self.dtype)
+
+        committed = self.count
+        self._append("vectors.bin", matrix, committed)
+        if scales is not None:
+            self._append("scales.bin", scales, committed)
+        if self.keep_full:
+            self._append("full.bin", vectors, committed)
+        count = committed + len(vectors)
+        self._map(count)
+
+        # Train the IVF lists once a chat is large enough, retraining when it has
+        # doubled. Each training writes new files, so readers that mapped the
+        # previous lists keep a consistent pair.
+        previous_ivf = self.ivf_trained_rows
+        if count >= IVF_MIN_ROWS and count >= 2 * self.ivf_trained_rows:
+            training = np.asarray(self.full) if self.full is not None else dequantize(self.vectors, self.scales)
+            centroids, assignments = build_ivf(training, int(np.sqrt(count)))
+            np.save(self._file(f"ivf_{count}_centroids.npy"), centroids)
+            assignments.tofile(self._file(f"ivf_{count}_assignments.bin"))
+            self.ivf_trained_rows = count
+        elif self.centroids is not None:
+            assignments = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+            self._append(f"ivf_{self.ivf_trained_rows}_assignments.bin", assignments, committed)
+
+        # The metadata file is written last; readers never see more rows than it promises
+        tmp_path = self._file(f".{META_FILE}.{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "dtype": self.dtype,
+                "keep_full": self.keep_full,
+                "dim": self.dim,
+                "count": count,
+                "ivf_trained_rows": self.ivf_trained_rows,
+            }, f)
+        os.replace(tmp_path, self._file(META_FILE))
+
+        if previous_ivf and previous_ivf != self.ivf_trained_rows:
+            for name in (f"ivf_{previous_ivf}_centroids.npy", f"ivf_{previous_ivf}_assignments.bin"):
+                try:
+                    os.remove(self._file(name))
+                except OSError:  # Still mapped by this process on Windows
+                    pass
+        self._load()
+
+    def search(self, queries, k, rerank=None, nprobe=IVF_NPROBE):
+        """Return one (rows, scores) pair per query, best first.
+
+        `rerank` defaults to re-ranking whenever float32 vectors are kept.
+        """
+        queries = normalize(np.atleast_2d(queries))
+        if not self.count:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+        rerank = self.full is not None if rerank is None else rerank and self.full is not None
+        fetch_k = k * RERANK_FACTOR if rerank else k
+
+        if self.centroids is None:
+            all_scores = score_rows(self.vectors, self.scales, queries)
+
+        results = []
+        for i, query in enumerate(queries):
+            if self.centroids is None:
+                rows = np.arange(self.count)
+                scores = all_scores[i]
+            else:
+                probes = top_k(self.centroids @ query, nprobe)
+                rows = np.flatnonzero(np.isin(self.assignments, probes))
+                scores = score_rows(
+                    self.vectors[rows],
+                    None if self.scales is None else self.scales[rows],
+                    query[None],
+                )[0]
+            best = top_k(scores, fetch_k)
+            candidates, candidate_scores = rows[best], scores[best]
+            if rerank:
+                # Read full-precision rows in file order to keep memory-mapped access sequential
+                candidates = np.sort(candidates)
+                candidate_scores = np.asarray(self.full[candidates]) @ query
+                best = top_k(candidate_scores, k)
+                candidates, candidate_scores = candidates[best], candidate_scores[best]
+            results.append((candidates[:k], candidate_scores[:k]))
+        return results
+
+    def get_vectors(self, rows):
+        """Vectors for the given rows, full precision when kept."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.full is not None:
+            return np.asarray(self.full[rows])
+        return dequantize(self.vectors[rows], None if self.scales is None else self.scales[rows])
+
+    def nbytes(self):
+        """Bytes used on disk by the index files."""
+        return sum(
+            os.path.getsize(self._file(name))
+            for name in os.listdir(self.path)
+            if name.endswith((".npy", ".bin")) or name == META_FILE
+        ) if os.path.isdir(self.path) else 0
+
+class CompactVectorStore(VectorStore):
+    """LangChain vector store over a CompactIndex, with one chunk per line of documents.jsonl."""
+
+    def __init__(self, persist_directory, embedding_function, dtype="int8", keep_full=False):
+        self.persist_directory = persist_directory
+        self._embedding = embedding_function
+        self.index = CompactIndex(persist_directory, dtype=dtype, keep_full=keep_full)
+        # Documents are appended before their vectors are committed, so the
+        # first index.count lines are complete even without holding the lock
+        self._load_records()
+
+    @property
+    def embeddings(self):
+        return self._embedding
+
+    def _load_records(self):
+        """Read the documents of the committed rows, returning the byte offset where they end."""
+        self.records = []
+        path = os.path.join(self.persist_directory, DOCUMENTS_FILE)
+        if not self.index.count or not os.path.exists(path):
+            return 0
+        with open(path, "rb") as f:
+            self.records = [json.loads(line) for line in itertools.islice(f, self.index.count)]
+            return f.tell()
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        return self.add_embeddings(texts, self._embedding.embed_documents(texts), metadatas, ids)
+
+    def add_embeddings(self, texts, embeddings, metadatas=None, ids=None):
+        """Add chunks whose embeddings have already been computed."""
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        if not texts:
+            return ids
+        records = [
+            {"id": id_, "text": text, "metadata": metadata}
+            for id_, text, metadata in zip(ids, texts, metadatas)
+        ]
+        with self.index.lock():
+            # Another worker may have added chunks since this handle was loaded
+            self.index._load()
+            end = self._load_records()
+            os.makedirs(self.persist_directory, exist_ok=True)
+            with open(os.path.join(self.persist_directory, DOCUMENTS_FILE), "ab") as f:
+                f.truncate(end)
+                f.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8"))
+            self.index._add(embeddings)
+            self.records.extend(records)
+        return ids
+
+    def _document(self, row):
+        record = self.records[row]
+        return Document(page_content=record["text"], metadata=record["metadata"])
+
+    def get_candidates(self, query_vectors, n):
+        """Union of the top n chunks for each query, with their stored vectors."""
+        rows = np.unique(np.concatenate([rows for rows, _ in self.index.search(query_vectors, n)]))
+        if not len(rows):
+            return [], []
+        return [self._document(row) for row in rows], self.index.get_vectors(rows)
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, **kwargs):
+        rows, scores = self.index.search(embedding, k, rerank=kwargs.get("rerank"))[0]
+        return [(self._document(row), float(score)) for row, score in zip(rows, scores)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding.embed_query(query), k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, **kwargs)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are already cosine similarities
+        return lambda score: score
+
+    def max_marginal_relevance_search_by_vector(self, embedding, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        rows, scores = self.index.search(embedding, fetch_k, rerank=kwargs.get("rerank"))[0]
+        if not len(rows):
+            return []
+        selected = mmr_select(scores, self.index.get_vectors(rows), k, lambda_mult)
+        return [self._document(rows[i]) for i in selected]
+
+    def max_marginal_relevance_search(self, query, k=4, fetch_k=20, lambda_mult=0.5, **kwargs):
+        return self.max_marginal_relevance_search_by_vector(
+            self._embedding.embed_query(query), k, fetch_k, lambda_mult, **kwargs
+        )
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, persist_directory=None, dtype="int8", keep_full=False, **kwargs):
+        if not persist_directory:
+            raise ValueError("persist_directory is required for a compact vector store")
+        store = cls(persist_directory, embedding, dtype=dtype, keep_full=keep_full)
+        store.add_texts(texts, metadatas=metadatas, ids=kwargs.get("ids"))
+        return store
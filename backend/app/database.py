@@ -1,12 +1,16 @@
 import sqlite3
-from typing import List, Dict, Tuple
+from typing import List, Dict, Optional, Tuple
 
 DATABASE = "chat_data.db"
+# Several uvicorn workers share this file, so wait on locks instead of failing fast
+BUSY_TIMEOUT = 30
 
 def init_db():
     """Initialize the database with required tables."""
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db_connection() as conn:
         cursor = conn.cursor()
+        # WAL lets readers in other worker processes proceed while one process writes
+        cursor.execute("PRAGMA journal_mode=WAL")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS chats (
                 chat_id TEXT PRIMARY KEY,
@@ -24,23 +28,50 @@ def init_db():
                 FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
             )
         """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_files (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS streams (
+                stream_id TEXT PRIMARY KEY,
+                chat_id TEXT NOT NULL,
+                message TEXT NOT NULL,
+                content TEXT NOT NULL DEFAULT '',
+                status TEXT NOT NULL DEFAULT 'running',
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY(chat_id) REFERENCES chats(chat_id)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS chat_versions (
+                chat_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
         conn.commit()
 
 def get_db_connection():
     """Get a connection to the database."""
-    conn = sqlite3.connect(DATABASE)
+    conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT)
     return conn
 
 def create_chat(chat_id: str, title: str = "New Chat", ):
     """Insert a new chat into the database."""
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("INSERT INTO chats (chat_id, title) VALUES (?, ?)", (chat_id, title))
         conn.commit()
 
 def save_message(chat_id: str, role: str, content: str):
     """Save a message to the database."""
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db_connection() as conn:
         cursor = conn.cursor()
 
         cursor.execute(
@@ -60,24 +91,165 @@ def save_message(chat_id: str, role: str, content: str):
 
 def fetch_chat_messages(chat_id: str) -> List[Dict]:
     """Fetch all messages for a given chat ID."""
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT role, content FROM messages WHERE chat_id = ? ORDER BY created_at", (chat_id,))
         messages = cursor.fetchall()
     return [{"role": role, "content": content} for role, content in messages]
 
+def fetch_chat(chat_id: str) -> Optional[Tuple[str, str]]:
+    """Fetch the chat ID and title for a single chat, or None if it does not exist."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT chat_id, title FROM chats WHERE chat_id = ?", (chat_id,))
+        return cursor.fetchone()
+
+def update_chat_title(chat_id: str, title: str):
+    """Update the title of a chat."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("UPDATE chats SET title = ? WHERE chat_id = ?", (title, chat_id))
+        conn.commit()
+
+def add_chat_files(chat_id: str, file_paths: List[str]) -> int:
+    """Record a batch of embedded files and bump the chat version once, in one transaction."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT INTO chat_files (chat_id, file_path) VALUES (?, ?)",
+            [(chat_id, file_path) for file_path in file_paths],
+        )
+        cursor.execute(
+            "INSERT INTO chat_versions (chat_id, version) VALUES (?, 1) "
+            "ON CONFLICT(chat_id) DO UPDATE SET version = version + 1",
+            (chat_id,),
+        )
+        cursor.execute("SELECT version FROM chat_versions WHERE chat_id = ?", (chat_id,))
+        version = cursor.fetchone()[0]
+        conn.commit()
+        return version
+
+def fetch_chat_files(chat_id: str) -> List[str]:
+    """Fetch the paths of all files embedded into a chat's vector store."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT file_path FROM chat_files WHERE chat_id = ? ORDER BY id", (chat_id,))
+        return [row[0] for row in cursor.fetchall()]
+
+def get_chat_version(chat_id: str) -> int:
+    """Get the cache version of a chat; per-process caches are stale once this changes."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM chat_versions WHERE chat_id = ?", (chat_id,))
+        row = cursor.fetchone()
+    return row[0] if row else 0
+
+def bump_chat_version(chat_id: str) -> int:
+    """Invalidate every worker's cached state for a chat by incrementing its version."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO chat_versions (chat_id, version) VALUES (?, 1) "
+            "ON CONFLICT(chat_id) DO UPDATE SET version = version + 1",
+            (chat_id,),
+        )
+        conn.commit()
+        cursor.execute("SELECT version FROM chat_versions WHERE chat_id = ?", (chat_id,))
+        return cursor.fetchone()[0]
+
+def create_stream(stream_id: str, chat_id: str, message: str):
+    """Register an in-flight generation for a chat message."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO streams (stream_id, chat_id, message) VALUES (?, ?, ?)",
+            (stream_id, chat_id, message),
+        )
+        conn.commit()
+
+def append_stream_content(stream_id: str, text: str):
+    """Persist the next part of a partial answer."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE streams SET content = content || ?, updated_at = CURRENT_TIMESTAMP WHERE stream_id = ?",
+            (text, stream_id),
+        )
+        conn.commit()
+
+def finish_stream(stream_id: str, status: str):
+    """Mark a generation as finished ('done') or failed ('error')."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE streams SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE stream_id = ?",
+            (status, stream_id),
+        )
+        conn.commit()
+
+def fetch_stream(stream_id: str) -> Optional[Dict]:
+    """Fetch a stream's partial answer, status and seconds since it last progressed."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT chat_id, content, status, (julianday('now') - julianday(updated_at)) * 86400 "
+            "FROM streams WHERE stream_id = ?",
+            (stream_id,),
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    chat_id, content, status, idle_seconds = row
+    return {"chat_id": chat_id, "content": content, "status": status, "idle_seconds": idle_seconds}
+
+def fetch_running_stream(chat_id: str, message: str, stale_seconds: float) -> Optional[str]:
+    """Find an in-flight generation for the same chat message that is still making progress."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT stream_id FROM streams WHERE chat_id = ? AND message = ? AND status = 'running' "
+            "AND (julianday('now') - julianday(updated_at)) * 86400 < ? ORDER BY created_at DESC",
+            (chat_id, message, stale_seconds),
+        )
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+def delete_old_streams(max_age_seconds: float):
+    """Delete streams that have not progressed for `max_age_seconds`, finished or abandoned."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "DELETE FROM streams WHERE (julianday('now') - julianday(updated_at)) * 86400 >= ?",
+            (max_age_seconds,),
+        )
+        conn.commit()
+
+def delete_chat_data(chat_id: str):
+    """Delete a chat with its messages and file records."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        cursor.execute("DELETE FROM chat_files WHERE chat_id = ?", (chat_id,))
+        cursor.execute("DELETE FROM streams WHERE chat_id = ?", (chat_id,))
+        cursor.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
+        conn.commit()
+    bump_chat_version(chat_id)
+
 def fetch_all_chats() -> List[Tuple[str, str]]:
     """Fetch all chat IDs and titles."""
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("SELECT chat_id, title FROM chats ORDER BY created_at DESC")
         return cursor.fetchall()
     
 def delete_all_data():
     """Delete all data from the database."""
-    with sqlite3.connect(DATABASE) as conn:
+    with get_db_connection() as conn:
         cursor = conn.cursor()
         cursor.execute("DELETE FROM messages")  # Delete all messages
+        cursor.execute("DELETE FROM chat_files")  # Delete all file records
+        cursor.execute("DELETE FROM streams")  # Delete all buffered responses
+        cursor.execute("UPDATE chat_versions SET version = version + 1")  # Invalidate caches
         cursor.execute("DELETE FROM chats")    # Delete all chats
         conn.commit()
         print("All data has been deleted from the database.")
@@ -85,10 +257,7 @@ def delete_all_data():
 if __name__ == "__main__":
     init_db()
 else:
-    # Auto-initialize when module is imported
-    with sqlite3.connect(DATABASE) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='chats'")
-        if not cursor.fetchone():
-            init_db()
+    # Auto-initialize when module is imported; every statement is idempotent so
+    # concurrent worker processes can race here safely
+    init_db()
 
@@ -1,5 +1,8 @@
-conversations = None
 llm = None
+embeddings = None
+# Async Ollama client for streamed replies, shared by every request in a worker
+ollama_client = None
+# Set once the lifespan warm-up has imported the heavy modules
+ready = False
 VECTOR_STORE_DIR = "./vector_store"
-EMBEDDING_MODEL = "nomic-embed-text"
-chat_file_mapping = {}
\ No newline at end of file
+EMBEDDING_MODEL = "nomic-embed-text"
\ No newline at end of file
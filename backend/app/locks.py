@@ -0,0 +1,36 @@
+"""Advisory file locks shared by every worker process.
+
+Kept free of app imports so that modules usable on their own, such as
+app.compact_store, can lock without opening the chat database.
+"""
+import os
+from contextlib import contextmanager
+
+@contextmanager
+def file_lock(path, shared=False):
+    """Hold an advisory lock on `path`, excluding other processes and handles."""
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        fcntl = None
+        import msvcrt
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+def store_lock(vector_store_path, shared=False):
+    """Lock a chat's vector store; the lock file sits beside the store directory."""
+    return file_lock(vector_store_path.rstrip("/\\") + ".lock", shared=shared)
@@ -1,11 +1,65 @@
+import asyncio
+import importlib
+import time
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes import chat_routes, history_routes, file_routes
 from app.database import init_db
-from app.utils import get_llm, load_conversations
+from app.utils import get_llm, get_embeddings, get_ollama_client
+from app import globals as app_globals
+
+# Modules deferred by the routes; importing them in the background after the
+# port is bound means the first real request does not pay for them
+WARMUP_MODULES = [
+    "langchain_core.runnables",
+    "ollama",
+    "langchain.prompts",
+    "langchain_text_splitters",
+    "langchain_chroma",
+    "numpy",
+    "app.rerank",
+    "app.compact_store",
+    "pymupdf",
+    "docx",
+    "pandas",
+    "magic",
+]
+
+def warm_up():
+    """Import the deferred modules, logging how long each one takes."""
+    for name in WARMUP_MODULES:
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+            print(f"Warm-up imported {name} in {time.perf_counter() - start:.2f}s")
+        except ImportError as e:
+            print(f"Warm-up could not import {name}: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Initialize database
+    init_db()
+
+    # Instantiate the model clients once per worker
+    app_globals.llm = get_llm()
+    app_globals.embeddings = get_embeddings()
+    app_globals.ollama_client = get_ollama_client(app_globals.llm.base_url)
+
+    async def run_warm_up():
+        await asyncio.get_event_loop().run_in_executor(None, warm_up)
+        app_globals.ready = True
+        print("Warm-up complete, ready to serve requests.")
+
+    warm_up_task = asyncio.create_task(run_warm_up())
+    yield
+    warm_up_task.cancel()
+    await app_globals.ollama_client.close()
+    app_globals.ollama_client = None
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -14,21 +68,26 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Prefill-Tokens-Saved", "X-Stream-Id", "X-Stream-Status"],
 )
 
-llm = get_llm()
-
-# Initialize database
-init_db()
-conversations = load_conversations(llm)
-
-# Instantiate the LLM model
-
 # Include routes
 app.include_router(chat_routes.router, prefix="/chat", tags=["Chat"])
 app.include_router(history_routes.router, prefix="/history", tags=["History"])
 app.include_router(file_routes.router, prefix="/upload", tags=["Upload"])
 
+@app.get("/health/live", tags=["Health"])
+async def liveness():
+    """The process is up and serving requests."""
+    return {"status": "alive"}
+
+@app.get("/health/ready", tags=["Health"])
+async def readiness():
+    """Model clients are built and warm-up has finished."""
+    if not app_globals.ready or app_globals.llm is None:
+        return JSONResponse(status_code=503, content={"status": "warming_up"})
+    return {"status": "ready"}
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
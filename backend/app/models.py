@@ -1,3 +1,4 @@
+from collections import OrderedDict
 from pydantic import BaseModel
 
 
@@ -25,14 +26,60 @@ class ChatDetail(BaseModel):
 class RenameChatRequest(BaseModel):
     title: str
 
+class ImportDirectoryRequest(BaseModel):
+    directory: str
+    recursive: bool = True
+
 class VectorDBState:
+    """Per-process cache of vector DB handles.
+
+    Each entry is tagged with the chat version from the shared catalog, so a
+    handle opened before another worker added files is treated as a miss.
+    """
     def __init__(self):
-        self.vector_db = None
-    
-    def set_vector_db(self, db):
-        self.vector_db = db
-    
-    def get_vector_db(self):
-        return self.vector_db
-
-vector_db_state = VectorDBState()
\ No newline at end of file
+        self.vector_dbs = {}
+
+    def set_vector_db(self, chat_id, db, version):
+        self.vector_dbs[chat_id] = (version, db)
+
+    def get_vector_db(self, chat_id, version):
+        cached = self.vector_dbs.get(chat_id)
+        if cached is None or cached[0] != version:
+            return None
+        return cached[1]
+
+    def invalidate(self, chat_id):
+        self.vector_dbs.pop(chat_id, None)
+
+vector_db_state = VectorDBState()
+
+class ContextCache:
+    """Per-process cache of Ollama generation context for each chat.
+
+    An entry is the token context returned after a chat's last turn, tagged
+    with the chat version and the number of stored messages it covers. Any
+    edit that changes the history (a new message from another worker, a
+    deletion, a summarization that bumps the chat version) makes it a miss.
+    """
+    def __init__(self, max_chats=128):
+        self.max_chats = max_chats
+        self.contexts = OrderedDict()
+        self.prefill_tokens_saved = 0
+
+    def set_context(self, chat_id, context, version, message_count):
+        self.contexts[chat_id] = (version, message_count, context)
+        self.contexts.move_to_end(chat_id)
+        while len(self.contexts) > self.max_chats:
+            self.contexts.popitem(last=False)
+
+    def get_context(self, chat_id, version, message_count):
+        cached = self.contexts.get(chat_id)
+        if cached is None or cached[0] != version or cached[1] != message_count:
+            return None
+        self.contexts.move_to_end(chat_id)
+        return cached[2]
+
+    def invalidate(self, chat_id):
+        self.contexts.pop(chat_id, None)
+
+context_cache = ContextCache()
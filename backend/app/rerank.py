@@ -0,0 +1,55 @@
+"""Rerank retrieved chunks with fused multi-query relevance and MMR diversity.
+
+All candidates from every expanded query are scored together: one matrix
+product gives each candidate's similarity to every query, and one more gives
+the candidate-to-candidate similarities that MMR needs. The greedy selection
+then only updates a vector per pick.
+"""
+import numpy as np
+
+def normalize(vectors):
+    """L2-normalise rows so that dot products are cosine similarities."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def fuse_relevance(query_vectors, candidate_vectors, original_weight=0.5):
+    """Relevance of each candidate across queries.
+
+    Row 0 of `query_vectors` is the user's question and the rest are its
+    rewrites; a candidate scores by its similarity to the question blended
+    with its best similarity to any rewrite.
+    """
+    similarities = normalize(query_vectors) @ normalize(candidate_vectors).T
+    if similarities.shape[0] == 1:
+        return similarities[0]
+    return original_weight * similarities[0] + (1 - original_weight) * similarities[1:].max(axis=0)
+
+def mmr_select(relevance, candidate_vectors, k, lambda_mult=0.5):
+    """Indices of k candidates in Maximal Marginal Relevance order."""
+    relevance = np.asarray(relevance, dtype=np.float32)
+    k = min(k, relevance.shape[0])
+    if k <= 0:
+        return []
+    vectors = normalize(candidate_vectors)
+    pairwise = vectors @ vectors.T
+
+    selected = [int(np.argmax(relevance))]
+    redundancy = pairwise[selected[0]].copy()
+    available = np.ones(relevance.shape[0], dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(redundancy, pairwise[best], out=redundancy)
+    return selected
+
+def rerank(query_vectors, candidate_vectors, k, lambda_mult=0.5, original_weight=0.5):
+    """Fuse relevance over all queries, then pick k diverse candidates."""
+    if not len(candidate_vectors):
+        return []
+    relevance = fuse_relevance(query_vectors, candidate_vectors, original_weight)
+    return mmr_select(relevance, candidate_vectors, k, lambda_mult)
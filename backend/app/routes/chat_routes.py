@@ -1,39 +1,43 @@
 import os
 import sys
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header
 from fastapi.responses import StreamingResponse
 from app.models import ChatRequest, ChatResponse, ChatSummary, ChatDetail
-from app.utils import create_retriever, create_chain, create_new_conversation, get_llm, save_conversations, load_conversations
-from app.database import save_message, get_db_connection
+from app.models import vector_db_state
+from app.utils import create_retriever, create_chain, create_new_conversation, create_vector_db, vector_store_exists, save_conversations, load_conversation, build_conversation_prompt, stream_conversation
+from app.database import save_message, update_chat_title, fetch_all_chats, fetch_chat_files, get_chat_version, fetch_stream
+from app.streams import start_stream, find_running_stream, subscribe
+from app import globals as app_globals
 import asyncio
-from langchain_chroma import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
-from app.globals import chat_file_mapping
 
 router = APIRouter()
 
-# Instantiate the LLM model using the utility function
-llm = get_llm()
+# The LLM is created by the lifespan hook in app.main and shared via app.globals
 VECTOR_STORE_DIR = "./vector_store"
 VECTOR_STORE_NAME = "simple-rag"
 EMBEDDING_MODEL = "nomic-embed-text"
-
-# Load conversations from storage
-conversations = load_conversations(llm)
+STREAM_HEADERS = {
+    "Content-Type": "text/event-stream",
+    "Cache-Control": "no-cache, no-transform",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+}
 
 def get_vector_db(chat_id):
-    """Always load fresh from persistence"""
-    if chat_id not in chat_file_mapping or not chat_file_mapping[chat_id]:
-        return None  
+    """Load from persistence, reusing this worker's handle while the chat version is unchanged"""
+    if not fetch_chat_files(chat_id):
+        return None
+
+    version = get_chat_version(chat_id)
+    vector_db = vector_db_state.get_vector_db(chat_id, version)
+    if vector_db is not None:
+        return vector_db
 
-    vector_store_path = os.path.join(VECTOR_STORE_DIR, chat_id)
-    if os.path.exists(vector_store_path):
+    if vector_store_exists(chat_id):
         try:
-            return Chroma(
-                persist_directory=vector_store_path,
-                embedding_function=OllamaEmbeddings(model=EMBEDDING_MODEL),
-                collection_name=chat_id  # Load collection by chat_id
-            )
+            vector_db = create_vector_db(chat_id=chat_id)  # Load collection by chat_id
+            vector_db_state.set_vector_db(chat_id, vector_db, version)
+            return vector_db
         except Exception as e:
             print(f"Error loading vector DB: {str(e)}")
             return None
@@ -43,19 +47,30 @@ def get_vector_db(chat_id):
 async def chat(request: ChatRequest):
     try:
         print("Received request:", request)
+        llm = app_globals.llm
         
-        chat_id = request.chat_id or create_new_conversation(conversations, llm, VECTOR_STORE_DIR, EMBEDDING_MODEL)
-        if chat_id not in conversations:
+        # Database reads and the vector store's file lock can block, so they
+        # run in a thread instead of stalling every request in this worker
+        chat_id = request.chat_id or await asyncio.to_thread(create_new_conversation)
+        chat_state = await asyncio.to_thread(load_conversation, chat_id)
+        if chat_state is None:
             raise HTTPException(status_code=400, detail="Invalid chat_id. Please start a new conversation.")
         
-        vector_db = get_vector_db(chat_id)
+        # A retry of a message that is still generating attaches to that generation
+        running_stream_id = await find_running_stream(chat_id, request.message)
+        if running_stream_id:
+            print(f"Attaching to in-flight stream {running_stream_id}")
+            return StreamingResponse(
+                subscribe(running_stream_id),
+                media_type="text/event-stream",
+                headers={**STREAM_HEADERS, "X-Stream-Id": running_stream_id},
+            )
+
+        vector_db = await asyncio.to_thread(get_vector_db, chat_id)
         print(f"Vector DB valid: {vector_db is not None}")
 
-        conversation = conversations.get(chat_id, {}).get("conversation")
-        if not conversation:
-            raise HTTPException(status_code=500, detail="Conversation object not found.")
-        
-        memory = conversations[chat_id]["memory"]
+        memory = chat_state["memory"]
+        history = list(memory.messages)
 
         # Add user message to memory in the correct format
         user_message = {"role": "user", "content": request.message}
@@ -63,6 +78,12 @@ async def chat(request: ChatRequest):
         print(f"Added user message to memory: {memory.messages}")
 
         response_text = ""
+        prefill_tokens_saved = 0
+        if not vector_db:
+            # Retrieved context changes every turn, so only plain conversations reuse cached context
+            prompt, context, prefill_tokens_saved = await asyncio.to_thread(
+                build_conversation_prompt, chat_id, history, request.message
+            )
 
         async def generate_response_stream():
             nonlocal response_text
@@ -82,23 +103,18 @@ async def chat(request: ChatRequest):
                         await asyncio.sleep(0.01)
 
                 else:
-                    # Use existing conversation (no RAG)
-                    for token in conversation.stream(request.message):  
+                    # Plain conversation (no RAG), continuing from cached context when possible
+                    message_count = len(history) + 2
+                    async for token in stream_conversation(chat_id, llm, prompt, context, message_count):
                         response_text += token  
                         yield token  
                         await asyncio.sleep(0.01)
                 
-                if conversations[chat_id]["title"] == "New Chat":
+                if chat_state["title"] == "New Chat":
                     new_title = request.message[:30] or "Untitled Chat"
 
-                    # Update in-memory title
-                    conversations[chat_id]["title"] = new_title
-
                     # Persist title update in the database
-                    with get_db_connection() as conn:
-                        cursor = conn.cursor()
-                        cursor.execute("UPDATE chats SET title = ? WHERE chat_id = ?", (new_title, chat_id))
-                        conn.commit()
+                    await asyncio.to_thread(update_chat_title, chat_id, new_title)
                     print(f"Chat title updated to: {new_title}")
 
                 if response_text.strip():  # Ensure response_text is not empty
@@ -106,33 +122,52 @@ async def chat(request: ChatRequest):
                     memory.add_message(ai_message)
                     print(f"Added AI message to memory: {ai_message}")
 
-                    save_message(chat_id, "user", request.message)
-                    save_message(chat_id, "ai", response_text)
-                    save_conversations(chat_id, memory)
+                    await asyncio.to_thread(save_message, chat_id, "user", request.message)
+                    await asyncio.to_thread(save_message, chat_id, "ai", response_text)
+                    await asyncio.to_thread(save_conversations, chat_id, memory)
                 else:
                     print("Response text is empty. Skipping save_message.")
             except Exception as e:
                 print(f"Error during streaming: {e}")
                 yield f"Error generating response: {str(e)}"
+                # Re-raised so the stream is recorded as failed rather than done
+                raise
+
+        # Generation runs in the background and is buffered, so a dropped
+        # connection neither stops it nor loses the answer
+        stream_id = await start_stream(chat_id, request.message, generate_response_stream())
 
         return StreamingResponse(
-            generate_response_stream(),
+            subscribe(stream_id),
             media_type="text/event-stream",  # Change to event-stream
             headers={
-                "Content-Type": "text/event-stream",
-                "Cache-Control": "no-cache, no-transform",
-                "Connection": "keep-alive",
-                "X-Accel-Buffering": "no",
+                **STREAM_HEADERS,
+                "X-Stream-Id": stream_id,
+                "X-Prefill-Tokens-Saved": str(prefill_tokens_saved),
             }
         )
     except Exception as e:
         print("Error:", str(e))
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.get("/stream/{stream_id}")
+async def resume_stream(stream_id: str, offset: int = 0, last_event_id: str | None = Header(None)):
+    """Reconnect to a generation, continuing after `offset` characters or the Last-Event-ID header"""
+    if last_event_id and last_event_id.isdigit():
+        offset = max(offset, int(last_event_id))
+    stream = await asyncio.to_thread(fetch_stream, stream_id)
+    if stream is None:
+        raise HTTPException(status_code=404, detail="Stream ID not found.")
+    return StreamingResponse(
+        subscribe(stream_id, offset),
+        media_type="text/event-stream",
+        headers={**STREAM_HEADERS, "X-Stream-Id": stream_id, "X-Stream-Status": stream["status"]},
+    )
+
 @router.post("/new_chat")
 async def new_chat():
     try:
-        chat_id = create_new_conversation(conversations, llm, VECTOR_STORE_DIR, EMBEDDING_MODEL)
+        chat_id = create_new_conversation()
         return {"chat_id": chat_id}
     except Exception as e:
         print("Error creating a new chat:", str(e))
@@ -141,7 +176,7 @@ async def new_chat():
 @router.get("/chats", response_model=list[ChatSummary])
 async def get_chats():
     try:
-        chat_summaries = [{"chat_id": chat_id, "title": data["title"]} for chat_id, data in conversations.items()]
+        chat_summaries = [{"chat_id": chat_id, "title": title} for chat_id, title in fetch_all_chats()]
         return chat_summaries
     except Exception as e:
         print("Error fetching chats:", str(e))
@@ -149,12 +184,13 @@ async def get_chats():
 
 @router.get("/{chat_id}", response_model=ChatDetail)
 async def get_chat_history(chat_id: str):
-    if chat_id not in conversations:
+    chat_state = load_conversation(chat_id)
+    if chat_state is None:
         raise HTTPException(status_code=404, detail="Chat ID not found.")
-    memory = conversations[chat_id]["memory"]
+    memory = chat_state["memory"]
     print("Memory object1:", memory)  # Debug print to check memory object
     messages = []
     for message in memory.messages:
         print("Message object:", message)  # Debug print to check each message
-        messages.append({"role": message.role, "content": message.content})
+        messages.append({"role": message["role"], "content": message["content"]})
     return {"chat_id": chat_id, "messages": messages}
\ No newline at end of file
@@ -1,18 +1,16 @@
 import os
 import logging
-import pymupdf
-from langchain.schema import Document
-from docx import Document as DocxDocument
 from fastapi import APIRouter, HTTPException, File, UploadFile
-from app.utils import create_vector_db, get_llm
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from app.models import vector_db_state
-from app.globals import chat_file_mapping
+from app.utils import create_vector_db, bulk_add_chunks
+from app.models import vector_db_state, ImportDirectoryRequest
+from app.database import add_chat_files
 import aiofiles
 from concurrent.futures import ThreadPoolExecutor
 import asyncio
-import pandas as pd
-import magic
+import time
+
+# Parsers (pymupdf, python-docx, pandas, python-magic) and the LangChain text
+# splitter are imported on first use to keep app startup fast
 
 router = APIRouter()
 process_executor = ThreadPoolExecutor(max_workers=4)
@@ -27,8 +25,9 @@ SUPPORTED_TYPES = {
     'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml': 'xlsx',
 }
 
-llm = get_llm()
 UPLOAD_FOLDER = "./uploads"
+# Server-side folders may only be imported from below this directory
+IMPORT_ROOT = os.path.realpath(os.getenv("IMPORT_ROOT", "./imports"))
 VECTOR_STORE_DIR = "./vector_store"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 shared_vector_db = None
@@ -37,15 +36,22 @@ EMBEDDING_MODEL = "nomic-embed-text"
 
 def extract_text_pymupdf(pdf_path):
     """Extract text from a PDF using PyMuPDF (fitz)."""
+    import pymupdf
     doc = pymupdf.open(pdf_path)
     text = "\n".join([page.get_text("text") for page in doc])
     if not text.strip():
         raise ValueError("No text found in the PDF.")
     return text
 
+def extract_text_docx(docx_path):
+    """Extract paragraph text from a Word document."""
+    from docx import Document as DocxDocument
+    return '\n'.join([p.text for p in DocxDocument(docx_path).paragraphs])
+
 async def detect_file_type(file_path: str):
     """Detect file type using python-magic"""
     try:
+        import magic
         mime = magic.Magic(mime=True)
         detected_type = mime.from_file(file_path)
         file_type = SUPPORTED_TYPES.get(detected_type, 'unknown')
@@ -79,7 +85,7 @@ async def extract_text(file_path: str, file_type: str):
     elif file_type == 'docx':
         return await asyncio.get_event_loop().run_in_executor(
             process_executor,
-            lambda: '\n'.join([p.text for p in DocxDocument(file_path).paragraphs])
+            lambda: extract_text_docx(file_path)
         )
     elif file_type in ('xlsx', 'xls'):
         return await process_excel(file_path, file_type)
@@ -95,6 +101,7 @@ async def process_excel(file_path: str, file_type: str):
 
 def pd_read_excel(file_path: str, file_type: str):
     """Excel-specific text conversion"""
+    import pandas as pd
     text = []
     try:
         xls = pd.ExcelFile(file_path)
@@ -105,34 +112,41 @@ def pd_read_excel(file_path: str, file_type: str):
     except Exception as e:
         raise ValueError(f"Excel processing failed: {str(e)}")
 
+async def load_chunks(file_path: str, filename: str):
+    """Detect, extract and split a single file into chunks"""
+    from langchain.schema import Document
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    # Detect file type
+    file_type = await detect_file_type(file_path)
+    if file_type == 'unknown':
+        print(f"Unsupported file: {filename}")
+        raise ValueError("Unsupported file format")
+
+    # Extract text
+    text = await extract_text(file_path, file_type)
+    print(f"File content extracted ({file_type.upper()})")
+
+    # Create document and split
+    document = await asyncio.get_event_loop().run_in_executor(
+        process_executor,
+        lambda: Document(page_content=text, metadata={"source": filename})
+    )
+    
+    chunks = await asyncio.get_event_loop().run_in_executor(
+        process_executor,
+        lambda: RecursiveCharacterTextSplitter(
+            chunk_size=1200, 
+            chunk_overlap=200
+        ).split_documents([document])
+    )
+    print(f"Split into {len(chunks)} chunks")
+    return chunks
+
 async def process_file(chat_id: str, file_path: str, filename: str):
     """Process files for a chat session, aggregating documents"""
     try:
-        existing_files = chat_file_mapping.get(chat_id, [])
-        # Detect file type
-        file_type = await detect_file_type(file_path)
-        if file_type == 'unknown':
-            print(f"Unsupported file: {filename}")
-            raise ValueError("Unsupported file format")
-
-        # Extract text
-        text = await extract_text(file_path, file_type)
-        print(f"File content extracted ({file_type.upper()})")
-
-        # Create document and split
-        document = await asyncio.get_event_loop().run_in_executor(
-            process_executor,
-            lambda: Document(page_content=text, metadata={"source": filename})
-        )
-        
-        chunks = await asyncio.get_event_loop().run_in_executor(
-            process_executor,
-            lambda: RecursiveCharacterTextSplitter(
-                chunk_size=1200, 
-                chunk_overlap=200
-            ).split_documents([document])
-        )
-        print(f"Split into {len(chunks)} chunks")
+        chunks = await load_chunks(file_path, filename)
 
         # Create vector DB
         vector_db = await asyncio.get_event_loop().run_in_executor(
@@ -140,15 +154,58 @@ async def process_file(chat_id: str, file_path: str, filename: str):
             lambda: create_vector_db(chunks, chat_id=chat_id)
         )
 
-        # Update state
-        vector_db_state.set_vector_db(vector_db)
-        chat_file_mapping.setdefault(chat_id, []).append(file_path)
+        # Update shared state; recording the file bumps the chat version so
+        # other workers drop their stale vector DB handles. The version comes
+        # from the same transaction, so a concurrent bump is never claimed here.
+        version = await asyncio.to_thread(add_chat_files, chat_id, [file_path])
+        vector_db_state.set_vector_db(chat_id, vector_db, version)
 
         return True
     except Exception as e:
         logging.error(f"Processing error: {e}")
         raise
 
+async def process_files(chat_id: str, files: list[tuple[str, str]]):
+    """Ingest many files at once: extract in parallel, then embed and insert in bulk"""
+    start = time.perf_counter()
+
+    # Extraction of every file is scheduled together and bounded by process_executor
+    results = await asyncio.gather(
+        *(load_chunks(file_path, filename) for file_path, filename in files),
+        return_exceptions=True,
+    )
+
+    chunks = []
+    ingested, failed = [], []
+    for (file_path, filename), result in zip(files, results):
+        if isinstance(result, Exception):
+            logging.error(f"Processing error for {filename}: {result}")
+            failed.append({"file": filename, "error": str(result)})
+        else:
+            chunks.extend(result)
+            ingested.append(file_path)
+
+    if chunks:
+        # One collection open and one embedding pipeline for the whole batch
+        vector_db = await asyncio.get_event_loop().run_in_executor(
+            None,
+            lambda: bulk_add_chunks(chunks, chat_id=chat_id)
+        )
+        version = await asyncio.to_thread(add_chat_files, chat_id, ingested)
+        vector_db_state.set_vector_db(chat_id, vector_db, version)
+
+    elapsed = time.perf_counter() - start
+    report = {
+        "files": len(ingested),
+        "failed": failed,
+        "chunks": len(chunks),
+        "seconds": round(elapsed, 3),
+        "docs_per_s": round(len(ingested) / elapsed, 2) if elapsed else 0.0,
+        "chunks_per_s": round(len(chunks) / elapsed, 2) if elapsed else 0.0,
+    }
+    print(f"Batch ingestion for chat {chat_id}: {report}")
+    return report
+
 @router.post("/{chat_id}")
 async def upload_file(chat_id: str, file: UploadFile = File(...)):
     """Upload endpoint with guaranteed completion before response"""
@@ -172,4 +229,67 @@ async def upload_file(chat_id: str, file: UploadFile = File(...)):
 
     except Exception as e:
         logging.error(f"Upload error: {e}")
-        raise HTTPException(500, "File processing failed") from e
\ No newline at end of file
+        raise HTTPException(500, "File processing failed") from e
+
+@router.post("/{chat_id}/batch")
+async def upload_files(chat_id: str, files: list[UploadFile] = File(...)):
+    """Upload several files in one request and ingest them as a single batch"""
+    try:
+        chat_upload_dir = os.path.join(UPLOAD_FOLDER, chat_id)
+        os.makedirs(chat_upload_dir, exist_ok=True)
+
+        filenames = [os.path.basename(file.filename) for file in files]
+        duplicates = sorted({name for name in filenames if filenames.count(name) > 1})
+        if duplicates:
+            raise HTTPException(400, f"Duplicate file names in batch: {', '.join(duplicates)}")
+
+        saved = []
+        for file, filename in zip(files, filenames):
+            file_path = os.path.join(chat_upload_dir, filename)
+            async with aiofiles.open(file_path, "wb") as f:
+                await f.write(await file.read())
+            saved.append((file_path, filename))
+
+        report = await process_files(chat_id, saved)
+        if not report["files"]:
+            raise HTTPException(500, "File processing failed")
+
+        return {"message": f"Processed {report['files']} of {len(saved)} files.", **report}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Batch upload error: {e}")
+        raise HTTPException(500, "File processing failed") from e
+
+@router.post("/{chat_id}/import")
+async def import_directory(chat_id: str, request: ImportDirectoryRequest):
+    """Ingest every file in a directory on the server, below IMPORT_ROOT"""
+    directory = os.path.realpath(os.path.join(IMPORT_ROOT, request.directory))
+    if os.path.commonpath([directory, IMPORT_ROOT]) != IMPORT_ROOT:
+        raise HTTPException(400, "Directory must be inside the import root")
+    if not os.path.isdir(directory):
+        raise HTTPException(404, "Directory not found")
+
+    try:
+        found = []
+        for root, dirs, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                found.append((os.path.join(root, filename), filename))
+            if not request.recursive:
+                break
+
+        if not found:
+            raise HTTPException(400, "Directory contains no files")
+
+        report = await process_files(chat_id, found)
+        if not report["files"]:
+            raise HTTPException(500, "File processing failed")
+
+        return {"message": f"Imported {report['files']} of {len(found)} files.", **report}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"Directory import error: {e}")
+        raise HTTPException(500, "File processing failed") from e
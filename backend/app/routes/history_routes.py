@@ -1,6 +1,6 @@
 from fastapi import APIRouter, HTTPException
-from app.models import ChatSummary, ChatDetail, RenameChatRequest
-from app.database import get_db_connection
+from app.models import ChatSummary, ChatDetail, RenameChatRequest, vector_db_state, context_cache
+from app.database import get_db_connection, delete_chat_data, update_chat_title
 
 router = APIRouter()
 
@@ -45,14 +45,9 @@ async def get_chat_history(chat_id: str):
 @router.delete("/{chat_id}")
 async def delete_chat(chat_id: str):
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
-        cursor.execute("DELETE FROM chats WHERE chat_id = ?", (chat_id,))
-        
-        conn.commit()
-        conn.close()
+        delete_chat_data(chat_id)
+        vector_db_state.invalidate(chat_id)
+        context_cache.invalidate(chat_id)
         
         return {"message": f"Chat {chat_id} deleted successfully."}
     except Exception as e:
@@ -62,12 +57,7 @@ async def delete_chat(chat_id: str):
 @router.put("/{chat_id}/rename")
 async def rename_chat(chat_id: str, request: RenameChatRequest):
     try: 
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute("UPDATE chats SET title = ? WHERE chat_id = ?", (request.title, chat_id))
-        conn.commit()
-        conn.close()
+        update_chat_title(chat_id, request.title)
 
         return {"message": "Chat renamed successfully."}
     except Exception as e:
@@ -0,0 +1,135 @@
+"""Server-side buffering of response streams so clients can reconnect.
+
+Each generation runs as a background task that is independent of any client
+connection. Its tokens go into a bounded ring buffer in the worker running it,
+and the partial answer is appended to the streams table every few tokens.
+Readers resume from a character offset (the Last-Event-ID of the stream).
+They are served from the ring buffer when it is in this worker, and from the
+persisted partial answer otherwise, including from other workers. Database
+calls run in a thread so they never block the event loop.
+"""
+import asyncio
+import os
+import time
+import uuid
+from collections import deque
+from app.database import create_stream, append_stream_content, finish_stream, fetch_stream, fetch_running_stream, delete_old_streams
+
+STREAM_BUFFER_TOKENS = 2048
+PERSIST_EVERY_TOKENS = 32
+PERSIST_EVERY_SECONDS = 1.0
+# How long a finished stream stays in memory for fast reconnects
+STREAM_RETENTION_SECONDS = 120
+# A running stream that has not progressed for this long lost its worker
+STALE_SECONDS = 60
+POLL_SECONDS = 0.25
+# Persisted streams are deleted once they have not progressed for this long;
+# a finished answer is in the chat history by then
+STREAM_TTL_SECONDS = int(os.getenv("STREAM_TTL_SECONDS", "3600"))
+
+class StreamBuffer:
+    """Ring buffer of (offset, token) pairs for one generation."""
+
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.tokens = deque(maxlen=STREAM_BUFFER_TOKENS)
+        self.length = 0
+        self.pending = []
+        self.last_persist = time.monotonic()
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def flush(self):
+        if self.pending:
+            text = "".join(self.pending)
+            self.pending = []
+            await asyncio.to_thread(append_stream_content, self.stream_id, text)
+        self.last_persist = time.monotonic()
+
+    async def append(self, token):
+        self.tokens.append((self.length, token))
+        self.length += len(token)
+        self.pending.append(token)
+        self._notify()
+        # Persisting well within the buffer size keeps the persisted text and
+        # the ring buffer overlapping, so no offset is ever unreachable
+        if len(self.pending) >= PERSIST_EVERY_TOKENS or time.monotonic() - self.last_persist >= PERSIST_EVERY_SECONDS:
+            await self.flush()
+
+    async def finish(self, status):
+        await self.flush()
+        await asyncio.to_thread(finish_stream, self.stream_id, status)
+        self.done = True
+        self._notify()
+
+    async def read(self, offset=0):
+        """Yield text from `offset` until the generation finishes."""
+        while True:
+            changed = self._changed
+            tokens = list(self.tokens)
+            buffer_start = tokens[0][0] if tokens else self.length
+            if offset < buffer_start:
+                # Older text has left the ring buffer but is already persisted
+                stream = await asyncio.to_thread(fetch_stream, self.stream_id)
+                chunk = stream["content"][offset:buffer_start] if stream else ""
+                if chunk:
+                    yield chunk
+                offset = buffer_start
+            for token_offset, token in tokens:
+                if token_offset + len(token) > offset:
+                    yield token[max(0, offset - token_offset):]
+                    offset = token_offset + len(token)
+            if self.done and offset >= self.length:
+                return
+            await changed.wait()
+
+active_streams = {}
+
+async def start_stream(chat_id, message, token_stream):
+    """Run `token_stream` in the background, buffering its output; returns the stream ID."""
+    stream_id = str(uuid.uuid4())
+    await asyncio.to_thread(delete_old_streams, STREAM_TTL_SECONDS)
+    await asyncio.to_thread(create_stream, stream_id, chat_id, message)
+    buffer = StreamBuffer(stream_id)
+
+    async def run():
+        status = "done"
+        try:
+            async for token in token_stream:
+                await buffer.append(token)
+        except Exception as e:
+            print(f"Error in stream {stream_id}: {e}")
+            status = "error"
+        finally:
+            await buffer.finish(status)
+            asyncio.get_event_loop().call_later(STREAM_RETENTION_SECONDS, active_streams.pop, stream_id, None)
+
+    active_streams[stream_id] = (buffer, asyncio.create_task(run()))
+    return stream_id
+
+async def find_running_stream(chat_id, message):
+    """Return the ID of an in-flight generation of the same message, so a retry can attach to it."""
+    return await asyncio.to_thread(fetch_running_stream, chat_id, message, STALE_SECONDS)
+
+async def read_persisted(stream_id, offset=0):
+    """Follow a stream through the database, for streams generated by another worker."""
+    while True:
+        stream = await asyncio.to_thread(fetch_stream, stream_id)
+        if stream is None:
+            return
+        if len(stream["content"]) > offset:
+            yield stream["content"][offset:]
+            offset = len(stream["content"])
+        if stream["status"] != "running" or stream["idle_seconds"] > STALE_SECONDS:
+            return
+        await asyncio.sleep(POLL_SECONDS)
+
+def subscribe(stream_id, offset=0):
+    """Text of a stream from `offset` on, live if it is generating in this worker."""
+    if stream_id in active_streams:
+        return active_streams[stream_id][0].read(offset)
+    return read_persisted(stream_id, offset)
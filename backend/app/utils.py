@@ -1,39 +1,67 @@
+import asyncio
 import os
 import uuid
-from langchain_community.chat_message_histories import ChatMessageHistory
-from langchain_ollama import OllamaLLM
-from langchain_chroma import Chroma
-from langchain_ollama import OllamaEmbeddings
-from langchain_core.runnables import RunnableWithMessageHistory, RunnableLambda
-from langchain.schema.messages import SystemMessage, HumanMessage, AIMessage
-from langchain.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from app.database import create_chat, save_message, fetch_chat_messages, fetch_all_chats
+from app import globals as app_globals
+from app.locks import store_lock
+from app.database import create_chat, save_message, fetch_chat_messages, fetch_chat, get_chat_version
 from typing import List, Dict
-from langchain.retrievers.multi_query import MultiQueryRetriever
-from operator import itemgetter
+
+# LangChain, Ollama and Chroma modules are imported inside the functions that
+# use them so that importing the app stays cheap; see scripts/profile_imports.py
 
 VECTOR_STORE_NAME = "simple-rag"
 EMBEDDING_MODEL = "nomic-embed-text"
 VECTOR_STORE_DIR = "./vector_store"
+# Chunks per embedding request during bulk ingestion, and how many requests run at once
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "2"))
+# "chroma" stores float32 vectors in Chroma; "float16" or "int8" use app.compact_store
+VECTOR_STORE_FORMAT = os.getenv("VECTOR_STORE_FORMAT", "chroma")
+# Keep float32 copies beside compact vectors so the top-k can be re-ranked exactly
+COMPACT_RERANK = os.getenv("COMPACT_RERANK", "0") == "1"
+# With several workers, a Chroma server (`chroma run --path ./vector_store --port 8001`)
+# is the most robust setup; set CHROMA_HOST to use it instead of embedded stores
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8001"))
+# Candidates fetched per expanded query, and how many the rerank stage keeps
+RERANK_POOL_PER_QUERY = 10
+RERANK_TOP_K = 5
+RERANK_LAMBDA = 0.25  # Diversity parameter, lower is more diverse
 
 def get_llm(model="deepseek-r1:1.5b", temperature=0.5):
+    from langchain_ollama import OllamaLLM
     return OllamaLLM(model=model, temperature=temperature)
-llm = get_llm()
+
+def get_embeddings(model=EMBEDDING_MODEL):
+    """Return the shared embedding client, creating one if the app has not started yet."""
+    if app_globals.embeddings is not None and app_globals.embeddings.model == model:
+        return app_globals.embeddings
+    from langchain_ollama import OllamaEmbeddings
+    return OllamaEmbeddings(model=model)
+
+def get_ollama_client(host=None):
+    """Return the shared async Ollama client, creating one if the app has not started yet."""
+    if app_globals.ollama_client is not None:
+        return app_globals.ollama_client
+    from ollama import AsyncClient
+    return AsyncClient(host=host)
+
 def generate_chat_id():
     return str(uuid.uuid4())
 
 def create_retriever(vector_db, llm):
-    """Create a multi-query retriever."""
-    if not hasattr(vector_db, 'as_retriever'):
+    """Create a multi-query retriever that returns a candidate pool for reranking.
+
+    The LLM rewrites the question, all queries are embedded in one request and
+    the store is searched for all of them at once. Ordering and the final cut
+    to RERANK_TOP_K are left to the rerank stage in create_chain.
+    """
+    from langchain.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.runnables import RunnableLambda
+
+    if not hasattr(vector_db, 'embeddings'):
         raise ValueError("Invalid vector DB instance")
-    base_retriever = vector_db.as_retriever(
-        search_type="mmr",  # Maximal Marginal Relevance
-        search_kwargs={
-            "k": 5,  # Number of docs to retrieve
-            "lambda_mult": 0.25  # Diversity parameter
-        }
-    )
     prompt_template = """
     You are an AI language model assistant. Your task is to generate five
     different versions of the given user question to retrieve relevant documents from
@@ -42,15 +70,100 @@ def create_retriever(vector_db, llm):
     similarity search. Provide these alternative questions separated by newlines.
     Original question: {question}
     """
+    query_chain = ChatPromptTemplate.from_template(prompt_template) | llm | StrOutputParser()
+
+    def retrieve(question):
+        rewrites = [line.strip() for line in query_chain.invoke({"question": question}).split("\n") if line.strip()]
+        queries = [question] + rewrites[:5]
+        print(f"Generated queries: {queries}")
+        query_vectors = vector_db.embeddings.embed_documents(queries)
+        documents, vectors = fetch_candidates(vector_db, query_vectors, RERANK_POOL_PER_QUERY)
+        return {"query_vectors": query_vectors, "documents": documents, "vectors": vectors}
 
-    retriever = MultiQueryRetriever.from_llm(
-        retriever=base_retriever,
-        llm=llm,
-        prompt=ChatPromptTemplate.from_template(prompt_template),
-        parser_key="lines"
-    )
     print("Retriever created.")
-    return retriever
+    return RunnableLambda(retrieve)
+
+def fetch_candidates(vector_db, query_vectors, n):
+    """Return the deduplicated top n chunks for every query, with their stored embeddings."""
+    from app.compact_store import CompactVectorStore
+    from langchain.schema import Document
+
+    if isinstance(vector_db, CompactVectorStore):
+        return vector_db.get_candidates(query_vectors, n)
+
+    # Chroma answers every query in one round trip and returns the stored vectors
+    results = vector_db._collection.query(
+        query_embeddings=query_vectors,
+        n_results=n,
+        include=["documents", "metadatas", "embeddings"],
+    )
+    seen = set()
+    documents, vectors = [], []
+    for ids, texts, metadatas, embeddings in zip(
+        results["ids"], results["documents"], results["metadatas"], results["embeddings"]
+    ):
+        for id_, text, metadata, embedding in zip(ids, texts, metadatas, embeddings):
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            documents.append(Document(page_content=text, metadata=metadata or {}))
+            vectors.append(embedding)
+    return documents, vectors
+
+def vector_store_exists(chat_id):
+    return bool(CHROMA_HOST) or os.path.exists(os.path.join(VECTOR_STORE_DIR, chat_id))
+
+def open_chroma(vector_store_path, chat_id, embedding):
+    """Open a chat's Chroma collection as it currently is on disk or on the server."""
+    from langchain_chroma import Chroma
+
+    if CHROMA_HOST:
+        return Chroma(
+            host=CHROMA_HOST,
+            port=CHROMA_PORT,
+            embedding_function=embedding,
+            collection_name=chat_id,
+        )
+
+    from chromadb.api.shared_system_client import SharedSystemClient
+
+    # chromadb shares one System per persist_directory across the process, so a
+    # new handle would keep serving the index as this worker first loaded it.
+    # Dropping the cached System makes the handle read what other workers wrote;
+    # handles already open keep a reference to the old one until released.
+    SharedSystemClient._identifier_to_system.pop(vector_store_path, None)
+    return Chroma(
+        persist_directory=vector_store_path,
+        embedding_function=embedding,
+        collection_name=chat_id,
+    )
+
+def uses_compact_store(vector_store_path):
+    """A chat keeps the format it was created with; new chats follow VECTOR_STORE_FORMAT."""
+    from app.compact_store import META_FILE
+
+    if os.path.exists(os.path.join(vector_store_path, META_FILE)):
+        return True
+    if os.path.exists(vector_store_path):
+        return False
+    return VECTOR_STORE_FORMAT != "chroma"
+
+def claim_vector_store(vector_store_path):
+    """Fix a chat's store format before its first write; returns True for a compact store.
+
+    The store directory is created under the store lock, so concurrent first
+    uploads from several workers agree on one format. A compact store's
+    directory appears together with its meta file, so a directory without one
+    is always a Chroma store.
+    """
+    with store_lock(vector_store_path):
+        if not os.path.exists(vector_store_path):
+            if VECTOR_STORE_FORMAT != "chroma":
+                from app.compact_store import create_compact_store
+                create_compact_store(vector_store_path, dtype=VECTOR_STORE_FORMAT, keep_full=COMPACT_RERANK)
+            else:
+                os.makedirs(vector_store_path)
+        return uses_compact_store(vector_store_path)
 
 def create_vector_db(chunks=None, chat_id=None):
     """Create or load a vector database."""
@@ -58,39 +171,91 @@ def create_vector_db(chunks=None, chat_id=None):
         raise ValueError("chat_id is required to create a vector DB")
     
     vector_store_path = os.path.join(VECTOR_STORE_DIR, chat_id)
-    embedding = OllamaEmbeddings(model=EMBEDDING_MODEL)
-
-    if chunks:
-        # Check if vector store exists
-        if os.path.exists(vector_store_path):
-            # Load existing collection and add new chunks
-            vector_db = Chroma(
-                persist_directory=vector_store_path,
-                embedding_function=embedding,
-                collection_name=chat_id  # Match existing collection
-            )
-            vector_db.add_documents(chunks)
-            print(f"Added {len(chunks)} chunks to existing vector DB for chat {chat_id}")
-        else:
-            # Create new persistent collection
-            vector_db = Chroma.from_documents(
-                documents=chunks,
-                embedding=embedding,
-                persist_directory=vector_store_path,
-                collection_name=chat_id
-            )
-            print(f"Created new vector DB with {len(chunks)} chunks for chat {chat_id}")
-        return vector_db
-    else:
-        # Load existing database
-        return Chroma(
+    embedding = get_embeddings()
+
+    existed = vector_store_exists(chat_id)
+    compact = claim_vector_store(vector_store_path) if chunks else uses_compact_store(vector_store_path)
+    if compact:
+        from app.compact_store import CompactVectorStore
+
+        vector_db = CompactVectorStore(
             persist_directory=vector_store_path,
             embedding_function=embedding,
-            collection_name=chat_id
+            dtype=VECTOR_STORE_FORMAT if VECTOR_STORE_FORMAT != "chroma" else "int8",
+            keep_full=COMPACT_RERANK,
         )
+        if chunks:
+            vector_db.add_documents(chunks)
+            print(f"Added {len(chunks)} chunks to compact vector DB for chat {chat_id}")
+        return vector_db
+
+    # Embedded Chroma is not safe for concurrent writers, so writes from every
+    # worker are serialized on the store's lock file
+    with store_lock(vector_store_path, shared=not chunks):
+        vector_db = open_chroma(vector_store_path, chat_id, embedding)
+        if chunks:
+            vector_db.add_documents(chunks)
+            if existed:
+                print(f"Added {len(chunks)} chunks to existing vector DB for chat {chat_id}")
+            else:
+                print(f"Created new vector DB with {len(chunks)} chunks for chat {chat_id}")
+    return vector_db
     
+def bulk_add_chunks(chunks, chat_id=None):
+    """Embed chunks from many files in fixed-size batches and insert them in bulk.
+
+    Unlike create_vector_db, which lets Chroma embed each upload separately, the
+    whole batch shares one collection open and as few embedding requests as the
+    batch size allows.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if not chat_id:
+        raise ValueError("chat_id is required to create a vector DB")
+
+    embedding = get_embeddings()
+    texts = [chunk.page_content for chunk in chunks]
+    batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=EMBED_CONCURRENCY) as executor:
+        embeddings = [vector for batch in executor.map(embedding.embed_documents, batches) for vector in batch]
+    print(f"Embedded {len(texts)} chunks in {len(batches)} requests for chat {chat_id}")
+
+    ids = [str(uuid.uuid4()) for _ in chunks]
+    metadatas = [chunk.metadata for chunk in chunks]
+    vector_store_path = os.path.join(VECTOR_STORE_DIR, chat_id)
+    if claim_vector_store(vector_store_path):
+        vector_db = create_vector_db(chat_id=chat_id)
+        vector_db.add_embeddings(texts, embeddings, metadatas, ids)
+        print(f"Inserted {len(chunks)} chunks into compact vector DB for chat {chat_id}")
+        return vector_db
+
+    from chromadb.utils.batch_utils import create_batches
+
+    with store_lock(vector_store_path):
+        # Opening creates the collection if it does not exist yet
+        vector_db = open_chroma(vector_store_path, chat_id, embedding)
+        for batch_ids, batch_embeddings, batch_metadatas, batch_documents in create_batches(
+            api=vector_db._client,
+            ids=ids,
+            embeddings=embeddings,
+            metadatas=metadatas,
+            documents=texts,
+        ):
+            vector_db._collection.upsert(
+                ids=batch_ids,
+                embeddings=batch_embeddings,
+                metadatas=batch_metadatas,
+                documents=batch_documents,
+            )
+    print(f"Inserted {len(chunks)} chunks into vector DB for chat {chat_id}")
+    return vector_db
+
 def create_chain(retriever, llm):
     """Create a RAG (Retrieve-then-Generate) chain."""
+    from langchain.prompts import ChatPromptTemplate
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.runnables import RunnableLambda
+
     template = """Answer the question based on the following context:
 
 
@@ -104,6 +269,13 @@ def create_chain(retriever, llm):
     2. If unclear, ask for clarification
     """
 
+    def rerank_candidates(pool):
+        from app.rerank import rerank
+
+        selected = rerank(pool["query_vectors"], pool["vectors"], RERANK_TOP_K, lambda_mult=RERANK_LAMBDA)
+        print(f"Reranked {len(pool['documents'])} candidates to {len(selected)}")
+        return [pool["documents"][i] for i in selected]
+
     def format_docs(docs):
         # Add debug print
         print(f"\n=== Retrieved {len(docs)} documents ===")
@@ -117,7 +289,7 @@ def create_chain(retriever, llm):
 
     chain = (
         {
-            "context": RunnableLambda(lambda x: x["question"]) | retriever | format_docs,
+            "context": RunnableLambda(lambda x: x["question"]) | retriever | rerank_candidates | format_docs,
             "question": RunnableLambda(lambda x: x["question"])
         }
         | prompt
@@ -137,6 +309,8 @@ class ChatMessageHistory:
     
     def to_base_messages(self):
         """Convert message history to a list of BaseMessages."""
+        from langchain.schema.messages import HumanMessage, AIMessage
+
         base_messages = []
         for msg in self.messages:
             if msg["role"] == "user":
@@ -159,39 +333,68 @@ class ChatMessageHistory:
 
 
 
-def create_new_conversation(conversations, llm, vector_store_dir, embedding_model):
-    chat_id = generate_chat_id()
-    memory = ChatMessageHistory()
-    print(f"Initialized memory object: {memory}")
+# Static system prefix shared by every turn of every chat. History is appended
+# after it in order, so consecutive prompts of a chat share a growing prefix
+# that the model backend can reuse instead of prefilling again.
+CONVERSATION_PREFIX = """You are an offline chatbot for OHCHR internal use. Provide accurate and contextual answers in English, Arabic, or Russian. 
+Your task is to provide accurate responses based on the user inqueries.
 
-    def get_session_history():
-        print(f"Returning session history: {memory} ({type(memory)}) with messages: {memory.messages}")
-        return memory
-    
-    prompt_template = """
-    You are an offline chatbot for OHCHR internal use. Provide accurate and contextual answers in English, Arabic, or Russian. 
+Conversation so far:
+"""
+
+def format_turn(role, content):
+    """Format one message the way it appears in conversation prompts."""
+    return f"User: {content}\n" if role == "user" else f"AI: {content}\n"
+
+def build_conversation_prompt(chat_id, history, message):
+    """Return (prompt, context, prefill_tokens_saved) for the next turn of a chat.
+
+    If this worker holds the Ollama context from the chat's previous turn and
+    the stored history has not changed since, only the new turn is sent along
+    with that context. Otherwise the full prompt is rebuilt from the history.
+    """
+    from app.models import context_cache
+
+    context = context_cache.get_context(chat_id, get_chat_version(chat_id), len(history))
+    if context:
+        return format_turn("user", message) + "AI:", context, len(context)
+    prompt = CONVERSATION_PREFIX + "".join(format_turn(m["role"], m["content"]) for m in history)
+    return prompt + format_turn("user", message) + "AI:", None, 0
 
-    Conversation so far:
-    {history}
+async def stream_conversation(chat_id, llm, prompt, context, message_count):
+    """Stream a reply from Ollama and cache the returned context for the next turn.
 
-    User: {input}
-    AI:
+    `message_count` is the number of stored messages once this turn is saved.
     """
+    from app.models import context_cache
+
+    client = get_ollama_client(llm.base_url)
+    final = None
+    async for part in await client.generate(
+        model=llm.model,
+        prompt=prompt,
+        context=context,
+        stream=True,
+        options={"temperature": llm.temperature},
+    ):
+        if part["response"]:
+            yield part["response"]
+        if part["done"]:
+            final = part
 
-    print("Initializing RunnableWithMessageHistory...")
-    conversation = RunnableWithMessageHistory(
-        llm,
-        history=memory,
-        system_message=SystemMessage(content="You are a helpful AI assistant."),
-        prompt_template=prompt_template,
-        get_session_history=get_session_history,
+    if final is not None and final.get("context"):
+        version = await asyncio.to_thread(get_chat_version, chat_id)
+        context_cache.set_context(chat_id, final["context"], version, message_count)
+    if context:
+        context_cache.prefill_tokens_saved += len(context)
+    print(
+        f"Chat {chat_id}: prefilled {final.get('prompt_eval_count') if final else 'unknown'} tokens, "
+        f"reused {len(context or [])} cached tokens ({context_cache.prefill_tokens_saved} saved in total)"
     )
 
-    conversations[chat_id] = {
-        "conversation": conversation,
-        "memory": memory,
-        "title": "New Chat"
-    }
+def create_new_conversation():
+    """Register a new chat in the shared database and return its ID."""
+    chat_id = generate_chat_id()
     create_chat(chat_id, "New Chat")
     return chat_id
 
@@ -199,45 +402,23 @@ def save_conversations(chat_id, memory):
     for message in memory.messages:
         save_message(chat_id, message["role"], message["content"])
 
-def load_conversations(llm):
-    conversations = {}
-    all_chats = fetch_all_chats()
-    for chat_id, title in all_chats:
-        print(f"Loading messages for chat_id: {chat_id}")
-        memory = ChatMessageHistory()
-        messages = fetch_chat_messages(chat_id)
-        for msg in messages:
-            memory.add_message({"role": msg["role"], "content": msg["content"]})
-        
-        def get_session_history():
-            print(f"Returning session history for chat_id {chat_id}: {memory.messages}")
-            return memory
-        
-        prompt_template = """
-        You are an offline chatbot for OHCHR internal use. Provide accurate and contextual answers in English, Arabic, or Russian. 
-        Your task is to provide accurate responses based on the user inqueries.
-        
-
-        Conversation so far:
-        {history}
-
-        User: {input}
-        AI:
-        """
-        system_message = SystemMessage(content="You are a helpful AI assistant.")
-        
-        conversation = RunnableWithMessageHistory(
-            llm,
-            history=memory,
-            system_message=system_message,
-            prompt_template=prompt_template,
-            get_session_history=get_session_history,  # Pass memory to restore session history
-        )
-        
-        # Store the reconstructed conversation object
-        conversations[chat_id] = {
-            "conversation": conversation,
-            "memory": memory,
-            "title": title,
-        }
-    return conversations
\ No newline at end of file
+def load_conversation(chat_id):
+    """Rebuild a chat from the database.
+
+    The database is the only source of truth, so any worker process can serve
+    any chat; returns None if the chat does not exist.
+    """
+    chat = fetch_chat(chat_id)
+    if chat is None:
+        return None
+    _, title = chat
+
+    print(f"Loading messages for chat_id: {chat_id}")
+    memory = ChatMessageHistory()
+    for msg in fetch_chat_messages(chat_id):
+        memory.add_message({"role": msg["role"], "content": msg["content"]})
+
+    return {
+        "memory": memory,
+        "title": title,
+    }
@@ -0,0 +1,69 @@
+"""Benchmark recall and footprint of the compact vector store layouts.
+
+Run from the backend directory:
+
+    python scripts/bench_compact_store.py [--rows 5000] [--dim 768] [--queries 200] [--k 5]
+
+Synthetic clustered vectors stand in for nomic-embed-text chunk embeddings.
+Each layout is scored by recall@k against exact float32 search, on-disk bytes
+and mean query latency.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import compact_store
+from app.compact_store import CompactIndex, normalize, top_k
+
+def make_corpus(rows, dim, queries, seed=0):
+    """Clustered unit vectors, with queries drawn near random corpus rows."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(rows // 50, 1), dim))
+    corpus = centers[rng.integers(0, len(centers), rows)] + 0.6 * rng.standard_normal((rows, dim))
+    picks = rng.integers(0, rows, queries)
+    query_vectors = corpus[picks] + 0.8 * rng.standard_normal((queries, dim))
+    return normalize(corpus), normalize(query_vectors)
+
+def run(label, corpus, queries, k, dtype, keep_full, rerank, ivf_min_rows):
+    compact_store.IVF_MIN_ROWS = ivf_min_rows
+    with tempfile.TemporaryDirectory() as workdir:
+        # A subdirectory, so the index's lock file is removed along with it
+        index = CompactIndex(os.path.join(workdir, "index"), dtype=dtype, keep_full=keep_full)
+        index.add(corpus)
+        exact = [set(top_k(corpus @ q, k)) for q in queries]
+
+        start = time.perf_counter()
+        results = index.search(queries, k, rerank=rerank)
+        latency_ms = (time.perf_counter() - start) * 1e3 / len(queries)
+
+        recall = np.mean([len(exact[i] & set(rows)) / k for i, (rows, _) in enumerate(results)])
+        print(f"{label:<28} {recall:>8.3f} {index.nbytes() / 2**20:>10.2f} {latency_ms:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus, queries = make_corpus(args.rows, args.dim, args.queries)
+    float32_mb = corpus.nbytes / 2**20
+    print(f"{args.rows} vectors x {args.dim} dims, float32 matrix would be {float32_mb:.2f} MiB\n")
+    print(f"{'layout':<28} {'recall@' + str(args.k):>8} {'disk MiB':>10} {'ms/query':>10}")
+
+    brute_force = args.rows + 1
+    ivf = min(args.rows, 1000)
+    run("float16", corpus, queries, args.k, "float16", False, False, brute_force)
+    run("int8", corpus, queries, args.k, "int8", False, False, brute_force)
+    run("int8 + float32 rerank", corpus, queries, args.k, "int8", True, True, brute_force)
+    run("int8 IVF", corpus, queries, args.k, "int8", False, False, ivf)
+    run("int8 IVF + float32 rerank", corpus, queries, args.k, "int8", True, True, ivf)
+
+if __name__ == "__main__":
+    main()
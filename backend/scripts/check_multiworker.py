@@ -0,0 +1,127 @@
+"""Check that two worker processes see each other's uploads to one chat.
+
+Run from the backend directory, once per vector store format:
+
+    VECTOR_STORE_FORMAT=chroma python scripts/check_multiworker.py
+    VECTOR_STORE_FORMAT=int8 python scripts/check_multiworker.py
+
+Two processes import the app the way two uvicorn workers would, in a scratch
+directory with their own chat_data.db and vector_store. They write chunks
+through the upload code paths and read through chat_routes.get_vector_db.
+Each worker must find the other's chunks, and concurrent bulk writes must
+lose nothing. Ollama is not needed: a deterministic fake embedding stands in
+for nomic-embed-text.
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CHAT_ID = "multiworker-check"
+ROUNDS = 3
+BULK_CHUNKS = 200
+
+def worker(workdir, name, conn):
+    os.chdir(workdir)
+    sys.path.insert(0, BACKEND_DIR)
+    from langchain_core.documents import Document
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from app import utils
+    from app.database import add_chat_files
+    from app.routes.chat_routes import get_vector_db
+
+    embedding = DeterministicFakeEmbedding(size=64)
+    utils.get_embeddings = lambda model=utils.EMBEDDING_MODEL: embedding
+
+    def chunks(tag, count):
+        return [Document(page_content=f"{name}-{tag}-{i}", metadata={"source": name}) for i in range(count)]
+
+    while True:
+        command, arg = conn.recv()
+        if command == "upload":
+            # Same steps as file_routes.process_file
+            utils.create_vector_db(chunks(arg, 20), chat_id=CHAT_ID)
+            add_chat_files(CHAT_ID, [f"{name}-{arg}"])
+            conn.send(None)
+        elif command == "bulk":
+            # Same steps as file_routes.process_files
+            utils.bulk_add_chunks(chunks(arg, BULK_CHUNKS), chat_id=CHAT_ID)
+            add_chat_files(CHAT_ID, [f"{name}-{arg}"])
+            conn.send(None)
+        elif command == "find":
+            vector_db = get_vector_db(CHAT_ID)
+            found = vector_db.similarity_search(arg, k=1) if vector_db else []
+            conn.send(bool(found) and found[0].page_content == arg)
+        elif command == "count":
+            vector_db = get_vector_db(CHAT_ID)
+            if vector_db is None:
+                conn.send(0)
+            elif hasattr(vector_db, "index"):
+                conn.send(vector_db.index.count)
+            else:
+                conn.send(vector_db._collection.count())
+        else:
+            conn.send(None)
+            return
+
+def main():
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as workdir:
+        sys.path.insert(0, BACKEND_DIR)
+        os.chdir(workdir)
+        from app.database import init_db, create_chat
+        init_db()
+        create_chat(CHAT_ID)
+
+        workers = {}
+        for name in ("a", "b"):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(target=worker, args=(workdir, name, child))
+            process.start()
+            child.close()  # so a crashed worker shows up as EOFError instead of a hang
+            workers[name] = (process, parent)
+
+        def call(name, command, arg=None):
+            workers[name][1].send((command, arg))
+            return workers[name][1].recv()
+
+        failures = []
+        def check(label, ok):
+            print(f"{'ok  ' if ok else 'FAIL'} {label}")
+            if not ok:
+                failures.append(label)
+
+        check("b sees no store before any upload", call("b", "count") == 0)
+        call("a", "upload", 1)
+        check("b finds a's chunk after a's upload", call("b", "find", "a-1-5"))
+        call("b", "upload", 2)
+        check("a finds b's chunk after b's upload", call("a", "find", "b-2-5"))
+        # Both workers now hold open handles; each must still see the other's next upload
+        call("a", "upload", 3)
+        check("b finds a's chunk after a second upload by a", call("b", "find", "a-3-5"))
+        call("b", "upload", 4)
+        check("a finds b's chunk after a second upload by b", call("a", "find", "b-4-5"))
+        check("a and b both count 80 chunks", call("a", "count") == call("b", "count") == 80)
+
+        for round_ in range(ROUNDS):
+            for name in workers:
+                workers[name][1].send(("bulk", f"bulk{round_}"))
+            for name in workers:
+                workers[name][1].recv()
+        expected = 80 + ROUNDS * BULK_CHUNKS * len(workers)
+        counts = {name: call(name, "count") for name in workers}
+        check(f"concurrent bulk writes keep all {expected} chunks {counts}", set(counts.values()) == {expected})
+        check("b finds a's last bulk chunk", call("b", "find", f"a-bulk{ROUNDS - 1}-7"))
+        check("a finds b's last bulk chunk", call("a", "find", f"b-bulk{ROUNDS - 1}-7"))
+
+        for name, (process, _) in workers.items():
+            call(name, "stop")
+            process.join()
+        os.chdir(BACKEND_DIR)
+
+    print(f"\n{'FAILED' if failures else 'PASSED'} ({os.getenv('VECTOR_STORE_FORMAT', 'chroma')})")
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""Report how long `import app.main` takes and which modules dominate it.
+
+Run from the backend directory:
+
+    python scripts/profile_imports.py [--top 25] [--module app.main]
+
+The report is built from CPython's `-X importtime` output, so the import runs in
+a fresh interpreter with nothing cached in sys.modules.
+"""
+import argparse
+import subprocess
+import sys
+
+def profile(module):
+    """Import `module` in a child interpreter and return (self_us, cumulative_us, name) rows."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        sys.stderr.write(result.stderr)
+        raise SystemExit(f"Importing {module} failed")
+
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append((int(self_us), int(cumulative_us), name.rstrip()))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--module", default="app.main")
+    parser.add_argument("--top", type=int, default=25)
+    args = parser.parse_args()
+
+    rows = profile(args.module)
+    total = next((cum for _, cum, name in rows if name.strip() == args.module), 0)
+    print(f"Import of {args.module}: {total / 1e6:.3f}s across {len(rows)} modules\n")
+
+    # Self time summed per top-level package adds up to the total without the
+    # double counting of nested cumulative times
+    packages = {}
+    for self_us, _, name in rows:
+        package = name.strip().split(".")[0]
+        count, package_us = packages.get(package, (0, 0))
+        packages[package] = (count + 1, package_us + self_us)
+
+    print(f"{'self':>10} {'modules':>8}  package")
+    for package, (count, package_us) in sorted(packages.items(), key=lambda item: -item[1][1])[:args.top]:
+        print(f"{package_us / 1e3:>8.1f}ms {count:>8}  {package}")
+
+if __name__ == "__main__":
+    main()